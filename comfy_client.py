@@ -1,19 +1,164 @@
 import uuid
-import json
+import orjson
 import asyncio
 import websockets
+from websockets.asyncio.client import connect as ws_connect
 import httpx
 from typing import Optional, Dict, Any
 
+# Connection options tuned for a fast local link to ComfyUI: skip
+# permessage-deflate (pure CPU cost on the tiny per-step JSON frames), lift
+# the 1 MiB frame cap (binary previews can exceed it) and drop keepalive
+# pings. If ComfyUI sits on the far side of a slow TLS link, re-enabling
+# compression="deflate" may be worth it.
+WS_CONNECT_KWARGS = dict(
+    compression=None,
+    max_size=None,
+    ping_interval=None,
+    ping_timeout=None,
+)
+
 class ComfyClient:
-    def __init__(self, base_url: str, ws_url: str):
+    # How long fetched /history entries stay cached (seconds).
+    HISTORY_CACHE_TTL = 60.0
+    # Minimum spacing between forwarded 'progress' events (seconds). ComfyUI
+    # emits one per sampler step; ~20/s is plenty for any progress bar.
+    PROGRESS_MIN_INTERVAL = 0.05
+
+    def __init__(self, base_url: str, ws_url: str, http_client: httpx.AsyncClient):
         self.base_url = base_url
         self.ws_url = ws_url
+        # One stable client_id for the lifetime of this client. ComfyUI is
+        # happy with a reused id; executions are distinguished by prompt_id.
         self.client_id = str(uuid.uuid4())
-        self.http_client = httpx.AsyncClient(base_url=base_url, timeout=None)
+        # Shared connection pool, owned (and closed) by the caller.
+        self.http_client = http_client
+        # prompt_id -> (fetched_at, history). History is immutable once a
+        # prompt finished, so callers wanting metadata after execute_workflow
+        # don't trigger a second /history round-trip.
+        self._history_cache: Dict[str, tuple[float, Dict[str, Any]]] = {}
+        # One long-lived websocket to ComfyUI shared by all executions,
+        # demultiplexed by prompt_id: the reader task routes each status
+        # message to the matching waiter queue. Saves a full HTTP upgrade
+        # per generation.
+        self._ws = None
+        self._ws_lock = asyncio.Lock()
+        self._ws_reader: Optional[asyncio.Task] = None
+        self._waiters: Dict[str, asyncio.Queue] = {}
+        # Messages whose prompt_id has no registered waiter yet (they can
+        # race the registration right after queue_prompt returns).
+        self._orphans: Dict[str, list] = {}
+        # Which prompt is currently executing, tracked from 'executing'
+        # messages. Binary frames carry no prompt_id, so this is how they
+        # get routed.
+        self._executing_prompt_id: Optional[str] = None
 
     async def close(self):
-        await self.http_client.aclose()
+        """Closes the persistent websocket. The http pool is owned by the caller."""
+        if self._ws_reader is not None:
+            self._ws_reader.cancel()
+            self._ws_reader = None
+        if self._ws is not None:
+            try:
+                await self._ws.close()
+            except Exception:
+                pass
+            self._ws = None
+
+    async def _ensure_ws(self):
+        """
+        Lazily connects the shared websocket and starts the reader task.
+        Reconnects with exponential backoff if the previous link dropped.
+        """
+        async with self._ws_lock:
+            if self._ws is not None and self._ws_reader is not None and not self._ws_reader.done():
+                return
+
+            delay = 0.5
+            for attempt in range(3):
+                try:
+                    self._ws = await ws_connect(f"{self.ws_url}/ws?clientId={self.client_id}", **WS_CONNECT_KWARGS)
+                    break
+                except Exception as e:
+                    if attempt == 2:
+                        raise
+                    print(f"ComfyUI websocket connect failed ({e}), retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    delay *= 2
+
+            self._ws_reader = asyncio.create_task(self._read_ws(self._ws))
+
+    async def _read_ws(self, ws):
+        try:
+            async for out in ws:
+                self._dispatch(out)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"ComfyUI websocket closed: {e}")
+        finally:
+            # Fail pending waiters so callers don't hang; the next execution
+            # reconnects lazily via _ensure_ws.
+            for queue in self._waiters.values():
+                queue.put_nowait({"type": "error", "message": "websocket to ComfyUI closed"})
+            self._ws = None
+
+    def _dispatch(self, out):
+        if not isinstance(out, str):
+            # Binary frame (preview or SaveImageWebsocket image). It carries
+            # no prompt_id, but ComfyUI executes one prompt at a time, so it
+            # belongs to whichever prompt is currently executing.
+            if self._executing_prompt_id is not None:
+                message = {"type": "binary", "data": out}
+                queue = self._waiters.get(self._executing_prompt_id)
+                if queue is not None:
+                    queue.put_nowait(message)
+                else:
+                    # Frame raced the waiter registration in _submit — park
+                    # it like orphaned text messages so it gets replayed.
+                    self._orphans.setdefault(self._executing_prompt_id, []).append(message)
+                    while len(self._orphans) > 8:
+                        self._orphans.pop(next(iter(self._orphans)))
+            return
+        message = orjson.loads(out)
+
+        data = message.get('data')
+        prompt_id = data.get('prompt_id') if isinstance(data, dict) else None
+
+        if message['type'] == 'executing' and prompt_id is not None:
+            self._executing_prompt_id = prompt_id if data.get('node') is not None else None
+
+        if prompt_id is None:
+            # Older ComfyUI omits prompt_id on some messages (e.g. progress).
+            # Broadcast so no waiter misses its events; only one prompt
+            # executes at a time anyway.
+            for queue in self._waiters.values():
+                queue.put_nowait(message)
+            return
+
+        queue = self._waiters.get(prompt_id)
+        if queue is not None:
+            queue.put_nowait(message)
+        else:
+            # Waiter not registered yet — park the message (bounded).
+            self._orphans.setdefault(prompt_id, []).append(message)
+            while len(self._orphans) > 8:
+                self._orphans.pop(next(iter(self._orphans)))
+
+    async def _submit(self, workflow: Dict[str, Any]) -> tuple[str, asyncio.Queue]:
+        """
+        Queues the prompt over the shared websocket session and registers
+        an event queue for its prompt_id. Callers must unregister the
+        queue from self._waiters when done.
+        """
+        await self._ensure_ws()
+        prompt_id = await self.queue_prompt(workflow)
+
+        queue: asyncio.Queue = asyncio.Queue()
+        for message in self._orphans.pop(prompt_id, []):
+            queue.put_nowait(message)
+        self._waiters[prompt_id] = queue
+        return prompt_id, queue
 
     async def queue_prompt(self, prompt: Dict[str, Any]) -> str:
         payload = {"prompt": prompt, "client_id": self.client_id}
@@ -22,9 +167,22 @@ class ComfyClient:
         return resp.json()["prompt_id"]
 
     async def get_history(self, prompt_id: str) -> Dict[str, Any]:
+        now = asyncio.get_running_loop().time()
+        cached = self._history_cache.get(prompt_id)
+        if cached is not None and now - cached[0] < self.HISTORY_CACHE_TTL:
+            return cached[1]
+
         resp = await self.http_client.get(f"/history/{prompt_id}")
         resp.raise_for_status()
-        return resp.json()[prompt_id]
+        history = orjson.loads(resp.content)[prompt_id]
+
+        # Evict stale entries on the way in so the cache stays bounded.
+        self._history_cache = {
+            pid: entry for pid, entry in self._history_cache.items()
+            if now - entry[0] < self.HISTORY_CACHE_TTL
+        }
+        self._history_cache[prompt_id] = (now, history)
+        return history
 
     async def get_image(self, filename: str, subfolder: str, folder_type: str) -> bytes:
         params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
@@ -32,72 +190,206 @@ class ComfyClient:
         resp.raise_for_status()
         return resp.content
 
+    async def stream_image(self, filename: str, subfolder: str, folder_type: str) -> httpx.Response:
+        """
+        Opens a streaming GET /view for an output file, so large results
+        (videos, big PNGs) are never buffered fully in memory.
+        The caller must close the returned response (resp.aclose()).
+        """
+        params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        req = self.http_client.build_request("GET", "/view", params=params)
+        resp = await self.http_client.send(req, stream=True)
+        try:
+            resp.raise_for_status()
+        except httpx.HTTPStatusError:
+            await resp.aclose()
+            raise
+        return resp
+
+    @staticmethod
+    def _is_done(message: Dict[str, Any], prompt_id: str) -> bool:
+        """True when this status message marks the prompt as finished."""
+        if message['type'] != 'executing':
+            return False
+        data = message['data']
+        return data['node'] is None and data['prompt_id'] == prompt_id
+
+    @staticmethod
+    def _select_image_output(outputs: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Returns the first image info found in history outputs, or None.
+        Nodes are walked in ascending node-id order so multi-output
+        workflows pick the same image every run, not whichever happens
+        to come first in dict-iteration order. The (length, value) key
+        sorts the usual numeric ids numerically while still totally
+        ordering arbitrary string ids.
+        """
+        return next(
+            (node_output["images"][0]
+             for _, node_output in sorted(outputs.items(), key=lambda kv: (len(kv[0]), kv[0]))
+             if "images" in node_output),
+            None,
+        )
+
+    @staticmethod
+    def _collect_executed(message: Dict[str, Any], prompt_id: str, outputs: Dict[str, Any]):
+        """
+        Records node outputs carried by 'executed' messages. Recent ComfyUI
+        includes them on the websocket, which lets callers skip the
+        /history round-trip entirely.
+        """
+        if message['type'] != 'executed':
+            return
+        data = message['data']
+        if data.get('prompt_id') == prompt_id and data.get('output') is not None:
+            outputs[data['node']] = data['output']
+
+    async def _await_completion(self, queue: asyncio.Queue, prompt_id: str,
+                                image_node_ids: frozenset = frozenset()) -> tuple[Dict[str, Any], Optional[bytes]]:
+        """
+        Consumes routed status messages until the prompt finishes executing,
+        without yielding events — the fast path for synchronous callers.
+        Returns any node outputs seen in 'executed' messages, plus the last
+        binary frame emitted while a node in image_node_ids was executing
+        (how SaveImageWebsocket delivers the final image).
+        """
+        outputs: Dict[str, Any] = {}
+        image_frame: Optional[bytes] = None
+        current_node = None
+        while True:
+            message = await queue.get()
+            if message['type'] == 'error':
+                raise Exception(message.get('message', 'websocket error'))
+            if message['type'] == 'binary':
+                if current_node in image_node_ids:
+                    image_frame = message['data']
+                continue
+            if message['type'] == 'executing':
+                current_node = message['data'].get('node')
+            self._collect_executed(message, prompt_id, outputs)
+            if self._is_done(message, prompt_id):
+                return outputs, image_frame
+
     async def execute_workflow_stream(self, workflow: Dict[str, Any]):
         """
         Yields workflow execution events: 'progress', 'executing', and finally 'result'.
+        'progress' events are rate-limited to one per PROGRESS_MIN_INTERVAL;
+        the latest skipped one is flushed before any state transition so the
+        bar is never stale. Other event types are never throttled.
         """
-        async with websockets.connect(f"{self.ws_url}/ws?clientId={self.client_id}") as ws:
-            prompt_id = await self.queue_prompt(workflow)
-            # print(f"Queued prompt: {prompt_id}")
-
+        prompt_id, queue = await self._submit(workflow)
+        # print(f"Queued prompt: {prompt_id}")
+        ws_outputs: Dict[str, Any] = {}
+        loop = asyncio.get_running_loop()
+        last_progress = 0.0
+        pending_progress = None
+        try:
             while True:
-                out = await ws.recv()
-                if isinstance(out, str):
-                    message = json.loads(out)
-                    
-                    if message['type'] in ['progress', 'executing', 'execution_start', 'execution_cached']:
-                        yield message
-                    
-                    if message['type'] == 'executing':
-                        data = message['data']
-                        if data['node'] is None and data['prompt_id'] == prompt_id:
-                            # Execution finished
-                            break
-            
-            # Execution finished, fetch history to get images
+                message = await queue.get()
+
+                if message['type'] == 'error':
+                    raise Exception(message.get('message', 'websocket error'))
+
+                if message['type'] == 'binary':
+                    # Preview frames aren't representable as SSE events.
+                    continue
+
+                if message['type'] == 'progress':
+                    now = loop.time()
+                    if now - last_progress < self.PROGRESS_MIN_INTERVAL:
+                        pending_progress = message
+                        continue
+                    last_progress = now
+                    pending_progress = None
+                    yield message
+                    continue
+
+                self._collect_executed(message, prompt_id, ws_outputs)
+
+                if pending_progress is not None:
+                    yield pending_progress
+                    pending_progress = None
+                    last_progress = loop.time()
+
+                if message['type'] in ['executing', 'execution_start', 'execution_cached']:
+                    yield message
+
+                if self._is_done(message, prompt_id):
+                    # Execution finished
+                    break
+        finally:
+            self._waiters.pop(prompt_id, None)
+
+        # Prefer outputs seen on the websocket; fall back to /history when
+        # the server didn't send them.
+        image_info = self._select_image_output(ws_outputs)
+        if image_info is None:
             history = await self.get_history(prompt_id)
-            outputs = history.get("outputs", {})
-            
-            # Find the first image output
-            for node_id, node_output in outputs.items():
-                if "images" in node_output:
-                    image_info = node_output["images"][0]
-                    yield {
-                        "type": "result",
-                        "data": image_info
-                    }
-                    return
-            
+            image_info = self._select_image_output(history.get("outputs", {}))
+        if image_info is None:
             raise Exception("No image output found in workflow history")
 
-    async def execute_workflow(self, workflow: Dict[str, Any]) -> tuple[bytes, str]:
+        yield {
+            "type": "result",
+            "data": image_info
+        }
+
+    async def execute_workflow(self, workflow: Dict[str, Any]) -> tuple["httpx.Response | bytes", str]:
         """
-        Executes a workflow synchronously and returns the image data.
+        Executes a workflow synchronously. Returns either the raw image
+        bytes (when the workflow outputs through SaveImageWebsocket) or an
+        open streaming response from /view, plus a filename. A returned
+        response must be closed by the caller.
+
+        Consumes the routed message queue directly rather than iterating
+        execute_workflow_stream, so the HTTP path doesn't pay a generator
+        suspend/resume per progress message.
         """
-        async for event in self.execute_workflow_stream(workflow):
-            if event['type'] == 'result':
-                image_info = event['data']
-                filename = image_info["filename"]
-                subfolder = image_info["subfolder"]
-                folder_type = image_info["type"]
-                
-                print(f"Downloading image: {filename}")
-                image_data = await self.get_image(filename, subfolder, folder_type)
-                return image_data, filename
-        
-        raise Exception("Workflow finished but no result returned")
+        # SaveImageWebsocket nodes emit the final image as a binary frame on
+        # the already-open socket, which skips the /view round-trip entirely.
+        ws_image_nodes = frozenset(
+            node_id for node_id, node in workflow.items()
+            if isinstance(node, dict) and node.get("class_type") == "SaveImageWebsocket"
+        )
+
+        prompt_id, queue = await self._submit(workflow)
+        try:
+            ws_outputs, image_frame = await self._await_completion(queue, prompt_id, ws_image_nodes)
+        finally:
+            self._waiters.pop(prompt_id, None)
+
+        if image_frame is not None:
+            # Binary frame layout: 4-byte big-endian event type, 4-byte image
+            # format (1 = JPEG, 2 = PNG), then the encoded image.
+            image_format = int.from_bytes(image_frame[4:8], "big")
+            ext = "jpeg" if image_format == 1 else "png"
+            return bytes(image_frame[8:]), f"{prompt_id}.{ext}"
 
-    async def upload_image(self, file_data: bytes, filename: str, overwrite: bool = False) -> Dict[str, Any]:
+        # Prefer outputs seen on the websocket; fall back to /history when
+        # the server didn't send them.
+        image_info = self._select_image_output(ws_outputs)
+        if image_info is None:
+            history = await self.get_history(prompt_id)
+            image_info = self._select_image_output(history.get("outputs", {}))
+        if image_info is None:
+            raise Exception("No image output found in workflow history")
+
+        filename = image_info["filename"]
+        print(f"Streaming image: {filename}")
+        resp = await self.stream_image(filename, image_info["subfolder"], image_info["type"])
+        return resp, filename
+
+    async def upload_image(self, file_obj, filename: str, content_type: Optional[str] = None, overwrite: bool = False) -> Dict[str, Any]:
         """
-        Uploads an image to ComfyUI.
+        Uploads an image to ComfyUI. file_obj may be a file-like object
+        (streamed through in chunks) or raw bytes.
         Returns the response dict containing 'name', 'subfolder', 'type'.
         """
-        files = {"image": (filename, file_data)}
+        files = {"image": (filename, file_obj, content_type or "application/octet-stream")}
         data = {"overwrite": str(overwrite).lower()}
         resp = await self.http_client.post("/upload/image", files=files, data=data)
         resp.raise_for_status()
         return resp.json()
-        return resp.json()
 
     async def interrupt(self, timeout: float = 1.0):
         """Interrupts the current execution."""
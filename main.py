@@ -5,13 +5,16 @@ from fastapi.responses import StreamingResponse, Response
 import httpx
 import asyncio
 import websockets
+from websockets.asyncio.client import connect as ws_connect
+from starlette.background import BackgroundTask
 from starlette.websockets import WebSocketDisconnect
 from starlette.status import HTTP_403_FORBIDDEN
+import hmac
 import os
-import json
+import orjson
 from typing import Optional
 from utils import load_workflow_template, update_workflow_inputs
-from comfy_client import ComfyClient
+from comfy_client import ComfyClient, WS_CONNECT_KWARGS
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -20,11 +23,14 @@ from contextlib import asynccontextmanager
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup
+    # Startup: one ComfyClient for the whole process, sharing the proxy's
+    # connection pool so all traffic to ComfyUI reuses the same keep-alive
+    # connections instead of maintaining two pools to the same origin.
+    client = ComfyClient(COMFY_BASE_URL, COMFY_WS_URL, http_client)
+    app.state.comfy = client
     yield
     # Shutdown
     print("Shutting down proxy...")
-    client = ComfyClient(COMFY_BASE_URL, COMFY_WS_URL)
     try:
         print("Interrupting running workflows...")
         # Use a short timeout for cleanup to avoid hanging
@@ -37,6 +43,10 @@ async def lifespan(app: FastAPI):
         await client.close()
         await http_client.aclose()
 
+
+def get_comfy(request: Request) -> ComfyClient:
+    return request.app.state.comfy
+
 app = FastAPI(lifespan=lifespan)
 
 import secrets
@@ -69,39 +79,117 @@ API_KEY_NAME = "X-API-Key"
 
 api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
 
-# Global HTTP client for proxying
-http_client = httpx.AsyncClient(base_url=COMFY_BASE_URL, timeout=None)
+# Connection-pool tuning for the backend. Defaults are generous so concurrent
+# proxying to the single ComfyUI origin doesn't queue on the pool, and the
+# keepalive expiry outlives typical server idle timeouts so connections
+# actually get reused instead of churning TCP/TLS handshakes.
+HTTPX_MAX_CONNECTIONS = int(os.getenv("COMFY_HTTPX_MAX_CONN", "1000"))
+HTTPX_MAX_KEEPALIVE = int(os.getenv("COMFY_HTTPX_MAX_KEEPALIVE", "200"))
+HTTPX_KEEPALIVE_EXPIRY = float(os.getenv("COMFY_HTTPX_KEEPALIVE", "75.0"))
+
+# Reject /upload payloads larger than this (bytes).
+MAX_UPLOAD_BYTES = int(os.getenv("COMFY_MAX_UPLOAD_BYTES", str(512 * 1024 * 1024)))
+
+# How long /run_workflow_stream coalesces events into one SSE frame (seconds).
+SSE_BATCH_WINDOW = 0.05
+
+# Write-coalescing window for the /ws proxy, in milliseconds. Text frames
+# arriving within the window go out as one JSON-array frame instead of one
+# send() syscall each. Set to 0 to forward every frame immediately.
+PROXY_WS_BATCH_MS = float(os.getenv("PROXY_WS_BATCH_MS", "10"))
+
+# Request headers never forwarded to the backend. Raw bytes, matching
+# Starlette's header storage (keys are already lowercase on the wire level).
+# Content-Length is forwarded as-is since the body is relayed verbatim.
+_EXCLUDED_REQUEST_HEADERS = frozenset((b"host", b"x-api-key"))
+
+# Hop-by-hop headers that must not be copied onto proxied responses: they
+# describe the upstream connection, and clash with Starlette's own framing
+# when re-streaming the body. Content-Length goes too since StreamingResponse
+# re-chunks. Content-Encoding stays — aiter_raw() forwards the body exactly
+# as encoded upstream.
+_HOP_BY_HOP_HEADERS = frozenset((
+    "transfer-encoding",
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailers",
+    "upgrade",
+    "content-length",
+))
+
+# Media types for workflow outputs, keyed by file extension.
+_MEDIA_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".webp": "image/webp",
+    ".mp4": "video/mp4",
+    ".webm": "video/webm",
+    ".mov": "video/quicktime",
+    ".mkv": "video/x-matroska",
+    ".txt": "text/plain",
+    ".json": "application/json",
+}
+
+# Global HTTP client for proxying. No total timeout (workflows can run for
+# minutes) but a bounded connect timeout, and retries=1 so a single dropped
+# keep-alive connection doesn't fail the request.
+http_client = httpx.AsyncClient(
+    base_url=COMFY_BASE_URL,
+    timeout=httpx.Timeout(None, connect=10.0),
+    transport=httpx.AsyncHTTPTransport(
+        retries=1,
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=HTTPX_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTPX_MAX_KEEPALIVE,
+            keepalive_expiry=HTTPX_KEEPALIVE_EXPIRY,
+        ),
+    ),
+)
+
+def _check_api_key(candidate: Optional[str]) -> bool:
+    # Constant-time comparison so the key can't be probed byte by byte.
+    # Compared as bytes: compare_digest raises TypeError on non-ASCII str,
+    # which would turn a bad credential into a 500.
+    if candidate is None:
+        return False
+    return hmac.compare_digest(
+        candidate.encode("utf-8", "surrogateescape"), API_KEY.encode()
+    )
 
 async def get_api_key(api_key_header: str = Security(api_key_header)):
-    if api_key_header == API_KEY:
+    if _check_api_key(api_key_header):
         return api_key_header
     raise HTTPException(
         status_code=HTTP_403_FORBIDDEN, detail="Could not validate credentials"
     )
 
 @app.post("/upload", dependencies=[Depends(get_api_key)])
-async def upload_image(image: UploadFile = File(...), overwrite: bool = Form(False)):
+async def upload_image(image: UploadFile = File(...), overwrite: bool = Form(False), client: ComfyClient = Depends(get_comfy)):
     """
     Uploads an image to ComfyUI for use in workflows.
     Returns the filename to be used in workflow inputs.
     """
-    client = ComfyClient(COMFY_BASE_URL, COMFY_WS_URL)
+    if image.size is not None and image.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="Upload too large")
     try:
-        file_content = await image.read()
-        resp = await client.upload_image(file_content, image.filename, overwrite=overwrite)
+        # Hand the underlying (spooled) file to httpx so the payload is
+        # streamed to ComfyUI instead of being read into memory first.
+        resp = await client.upload_image(image.file, image.filename, content_type=image.content_type, overwrite=overwrite)
         return resp
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        await client.close()
 
 @app.post("/run_workflow", dependencies=[Depends(get_api_key)])
-async def run_workflow(workflow: dict, request: Request):
+async def run_workflow(workflow: dict, request: Request, client: ComfyClient = Depends(get_comfy)):
     """
     Executes a raw ComfyUI workflow (API format).
     Returns the generated content (Image, Video, etc.) based on the output filename.
     """
-    client = ComfyClient(COMFY_BASE_URL, COMFY_WS_URL)
     try:
         # Execute synchronously
         # We use asyncio.wait_for to allow checking for client disconnects if needed,
@@ -109,23 +197,27 @@ async def run_workflow(workflow: dict, request: Request):
         # To handle disconnects, we can check request.is_disconnected() periodically
         # or rely on asyncio.CancelledError if the server cancels the task.
         
-        data, filename = await client.execute_workflow(workflow)
-        
+        result, filename = await client.execute_workflow(workflow)
+
         # Determine media type
-        ext = os.path.splitext(filename)[1].lower()
-        media_type = "application/octet-stream"
-        if ext in [".png", ".jpg", ".jpeg", ".webp"]:
-            media_type = f"image/{ext[1:]}"
-        elif ext in [".mp4", ".webm", ".mov", ".mkv"]:
-            media_type = f"video/{ext[1:]}"
-        elif ext in [".txt", ".json"]:
-            media_type = "text/plain"
-            
+        media_type = _MEDIA_TYPES.get(os.path.splitext(filename)[1].lower(), "application/octet-stream")
+
         # Add filename to headers so client knows what it got
         headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
-        
-        return Response(content=data, media_type=media_type, headers=headers)
-        
+
+        # SaveImageWebsocket workflows hand us the image bytes directly.
+        if isinstance(result, (bytes, bytearray)):
+            return Response(content=result, media_type=media_type, headers=headers)
+
+        # Otherwise stream straight from ComfyUI's /view response so large
+        # results never sit fully in the proxy's memory.
+        return StreamingResponse(
+            result.aiter_raw(65536),
+            media_type=media_type,
+            headers=headers,
+            background=BackgroundTask(result.aclose),
+        )
+
     except asyncio.CancelledError:
         print("Request cancelled by client. Interrupting ComfyUI...")
         await client.interrupt()
@@ -139,32 +231,67 @@ async def run_workflow(workflow: dict, request: Request):
         await client.clear_queue()
         await client.free_memory()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        await client.close()
 
 @app.post("/run_workflow_stream", dependencies=[Depends(get_api_key)])
-async def run_workflow_stream(workflow: dict, request: Request):
+async def run_workflow_stream(workflow: dict, request: Request, client: ComfyClient = Depends(get_comfy)):
     """
     Executes a workflow and streams progress events (SSE).
+    Each SSE frame carries a JSON array of events, coalesced over a short
+    window so per-step 'progress' spam doesn't become one TCP write each.
     Events: 'progress', 'executing', 'execution_start', 'execution_cached', 'result', 'error'.
     """
-    client = ComfyClient(COMFY_BASE_URL, COMFY_WS_URL)
-    
     async def event_generator():
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def pump():
+            try:
+                async for event in client.execute_workflow_stream(workflow):
+                    queue.put_nowait(event)
+            except Exception as e:
+                print(f"Error in stream: {e}")
+                queue.put_nowait({"type": "error", "message": str(e)})
+            finally:
+                queue.put_nowait(None)
+
+        pump_task = asyncio.create_task(pump())
+        loop = asyncio.get_running_loop()
+        finished = False
         try:
-            async for event in client.execute_workflow_stream(workflow):
+            while not finished:
+                first = await queue.get()
+                if first is None:
+                    break
+
+                # Drain whatever else arrives within the batch window into one
+                # frame. Terminal events ('result'/'error') end the batch at
+                # once so they are never delayed.
+                batch = [first]
+                deadline = loop.time() + SSE_BATCH_WINDOW
+                while batch[-1]["type"] not in ("result", "error"):
+                    try:
+                        event = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        remaining = deadline - loop.time()
+                        if remaining <= 0:
+                            break
+                        try:
+                            event = await asyncio.wait_for(queue.get(), timeout=remaining)
+                        except asyncio.TimeoutError:
+                            break
+                    if event is None:
+                        finished = True
+                        break
+                    batch.append(event)
+
                 # Check for client disconnect
                 if await request.is_disconnected():
                     print("Client disconnected, cancelling...")
                     await client.interrupt()
                     break
-                
-                yield f"data: {json.dumps(event)}\n\n"
-        except Exception as e:
-            print(f"Error in stream: {e}")
-            yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
+
+                yield b"data: " + orjson.dumps(batch) + b"\n\n"
         finally:
-            await client.close()
+            pump_task.cancel()
 
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
@@ -174,75 +301,126 @@ async def websocket_endpoint(ws: WebSocket):
     # For simplicity, we'll check query param 'token' or just allow if trusted network
     # But to be consistent, let's check a query param
     token = ws.query_params.get("token")
-    if token != API_KEY:
+    if not _check_api_key(token):
          await ws.close(code=1008)
          return
 
     await ws.accept()
     try:
-        async with websockets.connect(f"{COMFY_WS_URL}/ws") as comfy_ws:
+        async with ws_connect(f"{COMFY_WS_URL}/ws", **WS_CONNECT_KWARGS) as comfy_ws:
             
             async def forward_to_comfy():
-                try:
-                    while True:
-                        message = await ws.receive()
-                        if "text" in message:
-                            await comfy_ws.send(message["text"])
-                        elif "bytes" in message:
-                            await comfy_ws.send(message["bytes"])
-                except WebSocketDisconnect:
-                    pass
-                except Exception as e:
-                    print(f"Error forwarding to Comfy: {e}")
+                # Raises WebSocketDisconnect when the client goes away, which
+                # makes the TaskGroup cancel forward_to_client.
+                while True:
+                    message = await ws.receive()
+                    if message["type"] == "websocket.disconnect":
+                        raise WebSocketDisconnect(message.get("code", 1000))
+                    if "text" in message:
+                        await comfy_ws.send(message["text"])
+                    elif "bytes" in message:
+                        await comfy_ws.send(message["bytes"])
 
             async def forward_to_client():
-                try:
-                    while True:
-                        data = await comfy_ws.recv()
+                # Lets ConnectionClosed propagate when ComfyUI hangs up,
+                # cancelling forward_to_comfy via the TaskGroup.
+                batch_window = PROXY_WS_BATCH_MS / 1000.0
+                loop = asyncio.get_running_loop()
+                while True:
+                    data = await comfy_ws.recv()
+
+                    if not isinstance(data, str) or batch_window <= 0:
                         if isinstance(data, str):
                             await ws.send_text(data)
                         else:
                             await ws.send_bytes(data)
-                except websockets.exceptions.ConnectionClosed:
-                    pass
-                except Exception as e:
-                    print(f"Error forwarding to client: {e}")
+                        continue
 
-            await asyncio.gather(forward_to_comfy(), forward_to_client())
-            
-    except Exception as e:
-        print(f"WebSocket connection error: {e}")
-        await ws.close()
+                    # Coalesce text frames arriving within the window.
+                    # ComfyUI status messages are JSON objects, so the
+                    # batch goes out as a single JSON-array frame (the
+                    # frontend already handles arrays of packets). A
+                    # binary frame ends the batch and is sent after it
+                    # to preserve ordering.
+                    batch = [data]
+                    pending_bytes = None
+                    deadline = loop.time() + batch_window
+                    while len(batch) < 64:
+                        remaining = deadline - loop.time()
+                        if remaining <= 0:
+                            break
+                        try:
+                            nxt = await asyncio.wait_for(comfy_ws.recv(), timeout=remaining)
+                        except asyncio.TimeoutError:
+                            break
+                        if isinstance(nxt, str):
+                            batch.append(nxt)
+                        else:
+                            pending_bytes = nxt
+                            break
+
+                    if len(batch) == 1:
+                        await ws.send_text(batch[0])
+                    else:
+                        await ws.send_text("[" + ",".join(batch) + "]")
+                    if pending_bytes is not None:
+                        await ws.send_bytes(pending_bytes)
+
+            # Unlike gather(), a TaskGroup cancels the surviving forwarder as
+            # soon as the other side disconnects, so neither task leaks.
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(forward_to_comfy())
+                tg.create_task(forward_to_client())
+
+    except* (WebSocketDisconnect, websockets.exceptions.ConnectionClosed):
+        # Normal teardown: one side hung up and the sibling was cancelled.
+        pass
+    except* Exception as eg:
+        print(f"WebSocket connection error: {eg.exceptions}")
+        try:
+            await ws.close()
+        except Exception:
+            pass
 
 @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD", "PATCH"], dependencies=[Depends(get_api_key)])
 async def proxy(request: Request, path: str):
     url = httpx.URL(path=path, query=request.url.query.encode("utf-8"))
     
-    # Exclude headers that might cause issues
-    excluded_headers = {"host", "content-length", "x-api-key"}
-    headers = {
-        key: value 
-        for key, value in request.headers.items() 
-        if key.lower() not in excluded_headers
-    }
-    
+    # Iterate the raw header bytes — Starlette stores keys lowercase, so no
+    # per-header .lower()/decode allocations; httpx takes bytes tuples as-is.
+    headers = [
+        (key, value)
+        for key, value in request.headers.raw
+        if key not in _EXCLUDED_REQUEST_HEADERS
+    ]
+
     try:
-        # Read the body
-        content = await request.body()
-        
+        # Stream the request body through instead of materializing it in
+        # memory first — matters for model uploads and large image PUTs.
+        # Requests without a body (plain GETs) pass content=None so httpx
+        # doesn't switch them to chunked framing.
+        has_body = "content-length" in request.headers or "transfer-encoding" in request.headers
+
         req = http_client.build_request(
             request.method,
             url,
             headers=headers,
-            content=content
+            content=request.stream() if has_body else None
         )
-        
+
         r = await http_client.send(req, stream=True)
-        
+
+        # httpx already normalizes header keys to lowercase.
+        resp_headers = {
+            key: value
+            for key, value in r.headers.items()
+            if key not in _HOP_BY_HOP_HEADERS
+        }
+
         return StreamingResponse(
             r.aiter_raw(),
             status_code=r.status_code,
-            headers=r.headers,
+            headers=resp_headers,
             background=r.aclose
         )
     except Exception as e:
@@ -1,36 +1,63 @@
-import json
-import copy
+import os
+import orjson
+from functools import lru_cache
 
-def load_workflow_template(template_path: str) -> dict:
-    with open(template_path, "r") as f:
-        return json.load(f)
+@lru_cache(maxsize=32)
+def _load_template(template_path: str, mtime: float) -> tuple[dict, dict]:
+    # mtime is part of the cache key so editing a template busts the entry.
+    with open(template_path, "rb") as f:
+        workflow = orjson.loads(f.read())
 
-def update_workflow_inputs(workflow: dict, inputs: dict) -> dict:
+    # Precompute {class_type: node_id} once per template so callers don't
+    # re-scan the graph on every request. First node of a class wins,
+    # matching the old linear scan.
+    node_index: dict = {}
+    for node_id, node in workflow.items():
+        class_type = node.get("class_type")
+        if class_type is not None:
+            node_index.setdefault(class_type, node_id)
+
+    return workflow, node_index
+
+def load_workflow_template(template_path: str) -> tuple[dict, dict]:
+    """
+    Loads a workflow template (API format) plus a {class_type: node_id} index.
+
+    The result is cached per (path, mtime). Callers must not mutate the
+    returned workflow in place; update_workflow_inputs copies before writing.
+    """
+    return _load_template(template_path, os.path.getmtime(template_path))
+
+def update_workflow_inputs(workflow: dict, inputs: dict, node_index: dict = None) -> dict:
     """
     Updates the workflow dictionary with provided inputs.
-    
+
     Args:
         workflow: The loaded workflow dictionary (API format).
-        inputs: A dictionary of inputs to update. 
+        inputs: A dictionary of inputs to update.
                 Keys should map to node IDs or specific logical names if we map them.
                 For this simple version, we'll assume inputs keys map to:
                 - "prompt": Updates positive prompt text (Node 6)
                 - "seed": Updates KSampler seed (Node 3)
+        node_index: Optional {class_type: node_id} index from
+                load_workflow_template; built on the fly when absent.
     """
-    new_workflow = copy.deepcopy(workflow)
-    
-    # Simple mapping logic for the template
-    # Helper to find node by class type
-    def find_node_by_class(workflow, class_type):
+    # Only the node dicts and their "inputs" are written to, and input values
+    # are plain scalars, so a two-level copy is enough — much cheaper than
+    # copy.deepcopy on a nested graph.
+    new_workflow = {
+        node_id: {**node, "inputs": {**node.get("inputs", {})}}
+        for node_id, node in workflow.items()
+    }
+
+    if node_index is None:
+        node_index = {}
         for node_id, node in workflow.items():
-            if node.get("class_type") == class_type:
-                return node_id, node
-        return None, None
-
-    # Update Prompt (CLIPTextEncode)
-    # We assume the one with "positive" or just the first one is positive if we can't distinguish,
-    # but usually we rely on IDs. Let's try to stick to the IDs we defined in templates.
-    
+            class_type = node.get("class_type")
+            if class_type is not None:
+                node_index.setdefault(class_type, node_id)
+
+    # Simple mapping logic for the template
     # Text2Img / Img2Img (Juggernaut) IDs: 6 (Pos), 7 (Neg), 3 (KSampler), 5/10 (Latent), 11 (LoadImage)
     # Text2Vid (Wan) IDs: 2 (Pos), 3 (Neg), 5 (KSampler), 4 (Latent)
     # Img2Vid (Wan) IDs: 2 (Pos), 3 (Neg), 6 (KSampler), 5 (Latent), 4 (LoadImage)
@@ -46,10 +73,7 @@ def update_workflow_inputs(workflow: dict, inputs: dict) -> dict:
         elif "3" in new_workflow: new_workflow["3"]["inputs"]["text"] = inputs["negative_prompt"]
 
     # KSampler
-    sampler_id = None
-    if "3" in new_workflow and new_workflow["3"]["class_type"] == "KSampler": sampler_id = "3"
-    elif "5" in new_workflow and new_workflow["5"]["class_type"] == "KSampler": sampler_id = "5"
-    elif "6" in new_workflow and new_workflow["6"]["class_type"] == "KSampler": sampler_id = "6"
+    sampler_id = node_index.get("KSampler")
 
     if sampler_id:
         if "seed" in inputs: new_workflow[sampler_id]["inputs"]["seed"] = inputs["seed"]
@@ -59,19 +83,15 @@ def update_workflow_inputs(workflow: dict, inputs: dict) -> dict:
         if "scheduler" in inputs: new_workflow[sampler_id]["inputs"]["scheduler"] = inputs["scheduler"]
 
     # Empty Latent (Dimensions)
-    latent_id = None
-    if "5" in new_workflow and new_workflow["5"]["class_type"] == "EmptyLatentImage": latent_id = "5"
-    elif "4" in new_workflow and new_workflow["4"]["class_type"] == "EmptyLatentImage": latent_id = "4"
-    
+    latent_id = node_index.get("EmptyLatentImage")
+
     if latent_id:
         if "width" in inputs: new_workflow[latent_id]["inputs"]["width"] = inputs["width"]
         if "height" in inputs: new_workflow[latent_id]["inputs"]["height"] = inputs["height"]
         if "batch_size" in inputs: new_workflow[latent_id]["inputs"]["batch_size"] = inputs["batch_size"]
 
     # Load Image (for I2I / I2V)
-    load_image_id = None
-    if "11" in new_workflow and new_workflow["11"]["class_type"] == "LoadImage": load_image_id = "11"
-    elif "4" in new_workflow and new_workflow["4"]["class_type"] == "LoadImage": load_image_id = "4"
+    load_image_id = node_index.get("LoadImage")
 
     if load_image_id and "image_filename" in inputs:
         new_workflow[load_image_id]["inputs"]["image"] = inputs["image_filename"]